@@ -1,47 +1,589 @@
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
-import base64
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, Response
+from pydantic import BaseModel, ValidationError, model_validator
+from pydantic_core import PydanticCustomError
+import asyncio
 import binascii
+import gzip
+import hashlib
+import httpx
+import pybase64
 import re
-import requests
 import tempfile
 import os
 import shutil
-import subprocess
-from typing import Optional
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from starlette.types import Receive, Scope, Send
+from typing import Dict, Optional
+
+# Au-delà de cette taille, le décodage base64 est déporté dans le threadpool
+# pour ne pas bloquer la boucle d'événements
+B64_THREADPOOL_THRESHOLD = 1024 * 1024
+
+# Taille maximale acceptée pour un PDF (base64 ou téléchargé)
+MAX_PDF_BYTES = int(os.environ.get("MAX_PDF_BYTES", str(20 * 1024 * 1024)))
+
+# Taille des morceaux base64 décodés successivement vers le disque
+# (multiple de 4, soit 768 Kio décodés par morceau)
+B64_DECODE_CHUNK = 4 * 256 * 1024
+
+# Taille des morceaux lus lors du téléchargement d'un PDF
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Racine des répertoires de travail des conversions (PDF d'entrée et sortie
+# de pdf2htmlEX) ; la pointer vers un tmpfs (ex. /dev/shm/pdf2htmlex) évite
+# toute E/S disque, à condition que le tmpfs soit assez grand pour les
+# conversions en cours et pour le cache ci-dessous
+# Toujours rendu absolu : pdf2htmlEX est lancé avec le répertoire du job
+# comme cwd, un chemin relatif y serait résolu une seconde fois
+SCRATCH_DIR = os.path.abspath(
+    os.environ.get("SCRATCH_DIR", os.path.join(tempfile.gettempdir(), "pdf2htmlex"))
+)
+os.makedirs(SCRATCH_DIR, exist_ok=True)
+
+# Cache disque des conversions, indexé par le SHA-256 du PDF
+# Par défaut sous SCRATCH_DIR : sur le même système de fichiers, l'entrée
+# dans le cache est un simple renommage. Un CACHE_DIR placé ailleurs reste
+# possible, mais chaque HTML y est alors recopié (hors boucle d'événements)
+CACHE_DIR = os.path.abspath(os.environ.get("CACHE_DIR", os.path.join(SCRATCH_DIR, "cache")))
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Index LRU du cache : empreinte -> taille sur disque (HTML + version gzip),
+# le plus ancien en premier
+_cache_index: "OrderedDict[str, int]" = OrderedDict()
+_cache_size = 0
+
+# Entrées en cours de lecture ou d'envoi : empreinte -> nombre d'utilisateurs,
+# l'éviction les ignore jusqu'à leur libération
+_cache_pins: Dict[str, int] = {}
+
+# Compressions gzip en cours : empreinte -> tâche, partagée par les requêtes
+_gzip_tasks: Dict[str, "asyncio.Future[None]"] = {}
+
+# Durée maximale d'une conversion pdf2htmlEX (secondes)
+CONVERT_TIMEOUT = 300
+
+# Nombre maximal de conversions pdf2htmlEX simultanées (limite la RAM)
+MAX_CONCURRENT_CONVERSIONS = int(
+    os.environ.get("MAX_CONCURRENT_CONVERSIONS", str(max(1, (os.cpu_count() or 1) // 2)))
+)
+_convert_sem: Optional[asyncio.Semaphore] = None
+
+# Client HTTP partagé, créé au démarrage de l'application
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+async def _warm_up_pdf2htmlex() -> None:
+    """
+    Lance pdf2htmlEX une fois à vide pour charger le binaire et ses
+    bibliothèques (Poppler, FontForge, Cairo) dans le cache du système
+    La première conversion ne paie ainsi pas le chargement à froid
+    """
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            'pdf2htmlEX', '--version',
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+    except OSError:
+        # Binaire absent : la conversion remontera l'erreur
+        return
+    try:
+        await asyncio.wait_for(proc.wait(), timeout=30)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Ouvre le client HTTP partagé et recharge l'index du cache au démarrage,
+    ferme le client à l'arrêt
+    """
+    global _http_client
+    _cache_load()
+    _http_client = httpx.AsyncClient(
+        timeout=60,
+        follow_redirects=True,
+        # Connexions persistantes vers les hôtes PDF, avec nouvelle tentative
+        # si l'établissement de la connexion échoue
+        transport=httpx.AsyncHTTPTransport(
+            retries=2,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+        ),
+        # Demander explicitement un transfert compressé (décompressé par httpx)
+        headers={"Accept-Encoding": "gzip, deflate"}
+    )
+    await _warm_up_pdf2htmlex()
+    try:
+        yield
+    finally:
+        await _http_client.aclose()
+        _http_client = None
 
 # Créer l'application FastAPI
 app = FastAPI(
     title="PDF to HTML Conversion Service",
     description="Service de conversion PDF vers HTML utilisant pdf2htmlEX",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    # orjson sérialise les gros html_content bien plus vite que json
+    default_response_class=ORJSONResponse
 )
 
-# ==================== FONCTION DE VALIDATION ====================
+# Compresser les réponses JSON (le HTML généré se compresse très bien)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
-def b64_to_pdf_bytes(s: str) -> bytes:
+# ==================== MODÈLE DE REQUÊTE ====================
+
+class ConvertRequest(BaseModel):
+    """Body JSON de /convert, validé par pydantic-core"""
+    pdf_b64: Optional[str] = None
+    pdf_url: Optional[str] = None
+    file_name: Optional[str] = 'input.pdf'
+    return_url: bool = False
+    return_html: bool = False
+    
+    @model_validator(mode="after")
+    def check_source(self) -> "ConvertRequest":
+        if not self.pdf_b64 and not self.pdf_url:
+            raise PydanticCustomError("missing_source", "Either pdf_b64 or pdf_url must be provided")
+        return self
+
+def _validation_detail(e: ValidationError) -> str:
     """
-    Valide et décode une chaîne base64 en bytes PDF
-    Lève HTTPException si invalide
+    Message de 400 pour un body invalide : chaque erreur est préfixée par son
+    champ, les erreurs globales (source manquante, JSON illisible) restent nues
     """
+    return "; ".join(
+        f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" if err["loc"] else err["msg"]
+        for err in e.errors()
+    )
+
+# ==================== FONCTION DE VALIDATION ====================
+
+_WS_RE = re.compile(r"\s+")
+_B64_TAIL_RE = re.compile(r"[A-Za-z0-9+/]{2}(?:[A-Za-z0-9+/]{2}|[A-Za-z0-9+/]=|==)")
+
+def _clean_b64(s: str) -> str:
+    """Supprime les espaces blancs et l'éventuel préfixe data:"""
     # Nettoyer les espaces blancs
-    s = re.sub(r"\s+", "", s or "")
+    s = _WS_RE.sub("", s or "")
     
     # Supprimer le préfixe data: si présent
-    if s.startswith("data:"):
-        s = s.split(",", 1)[-1]
+    if s[:5] == "data:":
+        _, _, s = s.partition(",")
     
-    # Décoder le base64
+    return s
+
+def _check_b64_shape(s: str) -> None:
+    """
+    Rejette en O(1) une chaîne base64 manifestement invalide (longueur ou
+    remplissage final), avant de lancer le décodage complet
+    """
+    if len(s) % 4:
+        raise HTTPException(status_code=400, detail="Invalid base64: length is not a multiple of 4")
+    if not _B64_TAIL_RE.fullmatch(s[-4:]):
+        raise HTTPException(status_code=400, detail="Invalid base64: bad padding")
+
+def _decode_b64(s: str) -> bytes:
+    """
+    Décode une chaîne base64 déjà nettoyée
+    Lève HTTPException si invalide
+    """
+    # Décoder le base64 en mode strict quelle que soit la taille : décodeur
+    # SIMD (AVX2/SSSE3) de pybase64, qui se replie seul sur le code scalaire
+    # pour les petites entrées
     try:
-        data = base64.b64decode(s, validate=True)
-    except binascii.Error as e:
+        return pybase64.b64decode(s, validate=True)
+    except (binascii.Error, ValueError) as e:
         raise HTTPException(status_code=400, detail=f"Invalid base64: {e}")
+
+def _preallocate(f, size: int) -> None:
+    """
+    Réserve d'un coup l'espace du fichier pour que le système de fichiers
+    alloue un seul extent au lieu de l'agrandir à chaque écriture
+    """
+    if size > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            # Non supporté par le système de fichiers : simple optimisation
+            pass
+
+def _write_pdf_b64(s: str, pdf_path: str) -> str:
+    """
+    Décode le PDF base64 directement dans pdf_path, morceau par morceau,
+    sans jamais matérialiser le PDF complet en mémoire
+    Retourne le SHA-256 du PDF
+    Lève HTTPException si invalide
+    """
+    s = _clean_b64(s)
+    _check_b64_shape(s)
+    if len(s) // 4 * 3 > MAX_PDF_BYTES:
+        raise HTTPException(status_code=413, detail=f"PDF too large (max {MAX_PDF_BYTES} bytes)")
+    
+    hasher = hashlib.sha256()
+    
+    with open(pdf_path, 'wb') as f:
+        _preallocate(f, len(s) // 4 * 3 - s[-2:].count("="))
+        header = b""
+        for start in range(0, len(s), B64_DECODE_CHUNK):
+            piece = s[start:start + B64_DECODE_CHUNK]
+            # Chaque morceau est décodé seul : un remplissage en fin de morceau
+            # n'est légitime que pour le dernier
+            if piece.endswith("=") and start + B64_DECODE_CHUNK < len(s):
+                raise HTTPException(status_code=400, detail="Invalid base64: excess data after padding")
+            chunk = _decode_b64(piece)
+            if start == 0:
+                header = chunk[:4]
+            f.write(chunk)
+            hasher.update(chunk)
+        # Ne pas garder de zéros réservés au-delà des données décodées
+        f.truncate()
     
     # Vérifier que c'est bien un PDF
-    if not data.startswith(b"%PDF"):
+    if header != b"%PDF":
         raise HTTPException(status_code=400, detail="Not a PDF (missing %PDF header)")
     
-    return data
+    return hasher.hexdigest()
+
+# ==================== CACHE DES CONVERSIONS ====================
+
+_DIGEST_RE = re.compile(r"[0-9a-f]{64}")
+
+
+def _cache_path(digest: str) -> str:
+    return os.path.join(CACHE_DIR, f"{digest}.html")
+
+
+def _cache_gz_path(digest: str) -> str:
+    return os.path.join(CACHE_DIR, f"{digest}.html.gz")
+
+
+def _cache_load() -> None:
+    """Reconstruit l'index LRU à partir des fichiers déjà présents sur disque"""
+    global _cache_size
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.is_file() and entry.name.endswith(".tmp"):
+            # Reste d'une compression interrompue
+            os.unlink(entry.path)
+        elif entry.is_file() and entry.name.endswith(".html.gz"):
+            # Version gzip orpheline : jamais comptée dans le cache
+            if not os.path.exists(entry.path[:-len(".gz")]):
+                os.unlink(entry.path)
+        elif entry.is_file() and entry.name.endswith(".html"):
+            digest = entry.name[:-len(".html")]
+            st = entry.stat()
+            size = st.st_size
+            try:
+                size += os.path.getsize(_cache_gz_path(digest))
+            except FileNotFoundError:
+                pass
+            entries.append((st.st_mtime, digest, size))
+    _cache_index.clear()
+    _cache_size = 0
+    for _, digest, size in sorted(entries):
+        _cache_index[digest] = size
+        _cache_size += size
+    _cache_evict()
+
+
+def _cache_evict() -> None:
+    """Supprime les entrées les moins récemment utilisées au-delà du plafond"""
+    global _cache_size
+    # L'entrée la plus récente est toujours conservée
+    for digest in list(_cache_index)[:-1]:
+        if _cache_size <= CACHE_MAX_BYTES:
+            break
+        if digest in _cache_pins:
+            continue
+        _cache_size -= _cache_index.pop(digest)
+        for path in (_cache_path(digest), _cache_gz_path(digest)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def _cache_get(digest: str) -> Optional[str]:
+    """Retourne le chemin du HTML en cache pour ce PDF, ou None"""
+    global _cache_size
+    if digest not in _cache_index:
+        return None
+    path = _cache_path(digest)
+    try:
+        # Rafraîchir la date pour conserver l'ordre LRU après redémarrage
+        os.utime(path)
+    except FileNotFoundError:
+        _cache_size -= _cache_index.pop(digest)
+        return None
+    _cache_index.move_to_end(digest)
+    return path
+
+
+def _cache_pin(digest: str) -> None:
+    """Protège une entrée de l'éviction tant qu'elle est utilisée"""
+    _cache_pins[digest] = _cache_pins.get(digest, 0) + 1
+
+
+def _cache_unpin(digest: str) -> None:
+    """Libère une entrée épinglée et applique l'éviction différée"""
+    count = _cache_pins.pop(digest) - 1
+    if count:
+        _cache_pins[digest] = count
+    else:
+        _cache_evict()
+
+
+async def _cache_put(digest: str, html_path: str) -> str:
+    """Déplace le HTML généré dans le cache et retourne son nouveau chemin"""
+    global _cache_size
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = _cache_path(digest)
+    # Renommage si même système de fichiers, copie complète sinon : dans
+    # le threadpool pour ne pas bloquer la boucle pendant la copie
+    await run_in_threadpool(shutil.move, html_path, path)
+    # Une éventuelle version gzip correspond à l'ancien contenu
+    try:
+        os.unlink(_cache_gz_path(digest))
+    except FileNotFoundError:
+        pass
+    size = os.path.getsize(path)
+    _cache_size += size - _cache_index.pop(digest, 0)
+    _cache_index[digest] = size
+    _cache_evict()
+    return path
+
+
+def _gzip_file(src: str, dst: str) -> int:
+    """Compresse src vers dst de façon atomique et retourne la taille écrite"""
+    fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(dst))
+    os.close(fd)
+    try:
+        with open(src, 'rb') as f_in, gzip.open(tmp, 'wb', compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.replace(tmp, dst)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return os.path.getsize(dst)
+
+
+async def _gzip_entry(digest: str) -> None:
+    """Compresse une entrée du cache et compte la taille du .gz une seule fois"""
+    global _cache_size
+    size = await run_in_threadpool(_gzip_file, _cache_path(digest), _cache_gz_path(digest))
+    if digest in _cache_index:
+        _cache_index[digest] += size
+        _cache_size += size
+        _cache_evict()
+
+
+def _gzip_done(digest: str, task: "asyncio.Future[None]") -> None:
+    """Libère l'entrée une fois la compression terminée, réussie ou non"""
+    _gzip_tasks.pop(digest, None)
+    _cache_unpin(digest)
+    if not task.cancelled():
+        # L'erreur est déjà remontée aux requêtes en attente : éviter le
+        # message « Task exception was never retrieved » si toutes sont parties
+        task.exception()
+
+
+async def _cache_gzip(digest: str) -> str:
+    """
+    Retourne le chemin de la version gzip d'une entrée du cache,
+    en la créant une seule fois si besoin (compression hors boucle)
+    """
+    gz_path = _cache_gz_path(digest)
+    if not os.path.exists(gz_path):
+        # Les requêtes simultanées attendent la même compression
+        task = _gzip_tasks.get(digest)
+        if task is None:
+            task = asyncio.ensure_future(_gzip_entry(digest))
+            _gzip_tasks[digest] = task
+            # La tâche épingle l'entrée elle-même : elle peut survivre aux
+            # requêtes qui l'attendent et ne doit pas perdre son .html
+            _cache_pin(digest)
+            task.add_done_callback(lambda t: _gzip_done(digest, t))
+        # Un client qui se déconnecte n'interrompt pas la compression des autres
+        await asyncio.shield(task)
+    return gz_path
+
+
+class _CachedFileResponse(FileResponse):
+    """FileResponse qui libère son entrée du cache une fois l'envoi terminé"""
+    
+    def __init__(self, digest: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.digest = digest
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            _cache_unpin(self.digest)
+
+
+async def _html_file_response(digest: str, html_path: str, request: Request,
+                              filename: Optional[str] = None) -> FileResponse:
+    """
+    Sert une entrée du cache en streaming depuis le disque, sans la charger
+    en mémoire, dans sa version gzip si le client l'accepte
+    L'entrée reste épinglée jusqu'à la fin de l'envoi
+    """
+    kwargs = {"filename": filename, "content_disposition_type": "inline"} if filename else {}
+    _cache_pin(digest)
+    try:
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            return _CachedFileResponse(
+                digest,
+                await _cache_gzip(digest),
+                media_type="text/html; charset=utf-8",
+                headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+                **kwargs
+            )
+        return _CachedFileResponse(digest, html_path, media_type="text/html; charset=utf-8", **kwargs)
+    except BaseException:
+        _cache_unpin(digest)
+        raise
+
+# ==================== CONVERSION ====================
+
+# Partie fixe de la ligne de commande pdf2htmlEX, construite une seule fois
+PDF2HTMLEX_ARGS = (
+    'pdf2htmlEX',
+    '--zoom', '1.3',
+    '--process-outline', '0',
+    '--embed-css', '1',
+    '--embed-javascript', '1',
+    '--embed-image', '1',
+    '--embed-font', '1',
+    # Pas de messages de progression : seules les erreurs sont écrites
+    '--quiet', '1',
+)
+
+# Seule la fin de stderr est conservée pour les messages d'erreur
+STDERR_TAIL_BYTES = 8 * 1024
+
+async def _read_tail(stream: asyncio.StreamReader, limit: int) -> bytes:
+    """Vide le flux au fil de l'eau en ne gardant que ses limit derniers octets"""
+    tail = bytearray()
+    while True:
+        chunk = await stream.read(64 * 1024)
+        if not chunk:
+            return bytes(tail)
+        tail += chunk
+        if len(tail) > limit:
+            del tail[:-limit]
+
+def _get_convert_sem() -> asyncio.Semaphore:
+    """
+    Retourne le sémaphore des conversions, créé au premier appel pour être
+    lié à la boucle d'événements en cours (Python 3.8 le lie à la création)
+    """
+    global _convert_sem
+    if _convert_sem is None:
+        _convert_sem = asyncio.Semaphore(MAX_CONCURRENT_CONVERSIONS)
+    return _convert_sem
+
+async def _run_pdf2htmlex(pdf_path: str, output_dir: str) -> None:
+    """
+    Exécute pdf2htmlEX en sous-processus asynchrone, sans occuper de thread
+    Le HTML est écrit dans output_dir/output.html
+    Lève HTTPException en cas d'échec ou de dépassement du délai
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *PDF2HTMLEX_ARGS,
+        pdf_path,
+        'output.html',
+        cwd=output_dir,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    
+    try:
+        stderr, _ = await asyncio.wait_for(
+            asyncio.gather(_read_tail(proc.stderr, STDERR_TAIL_BYTES), proc.wait()),
+            timeout=CONVERT_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise HTTPException(status_code=504, detail="Conversion timeout (>5 minutes)")
+    except asyncio.CancelledError:
+        # Requête annulée : ne pas laisser pdf2htmlEX tourner orphelin
+        proc.kill()
+        raise
+    
+    if proc.returncode != 0:
+        error_msg = stderr.decode('utf-8', errors='replace') if stderr else f"exit status {proc.returncode}"
+        raise HTTPException(status_code=500, detail=f"pdf2htmlEX failed: {error_msg}")
+
+
+def _read_text(path: str) -> str:
+    """
+    Lit le HTML en un seul bloc et le décode en une passe, sans le décodeur
+    incrémental ni la traduction des fins de ligne du mode texte
+    """
+    with open(path, 'rb') as f:
+        return f.read().decode('utf-8')
+
+# ==================== TÉLÉCHARGEMENT ====================
+
+async def _download_pdf(url: str, pdf_path: str) -> str:
+    """
+    Télécharge un PDF directement dans pdf_path, par morceaux, sans bloquer
+    la boucle d'événements ni garder le contenu en mémoire
+    Retourne le SHA-256 du PDF
+    Lève HTTPException si le téléchargement échoue, dépasse MAX_PDF_BYTES
+    ou si ce n'est pas un PDF
+    """
+    too_large = HTTPException(status_code=413, detail=f"PDF too large (max {MAX_PDF_BYTES} bytes)")
+    hasher = hashlib.sha256()
+    received = 0
+    with open(pdf_path, 'w+b') as f:
+        try:
+            async with _http_client.stream("GET", url) as response:
+                response.raise_for_status()
+                
+                # Refuser d'emblée si la taille annoncée (non compressée)
+                # dépasse la limite
+                content_length = response.headers.get("Content-Length", "")
+                if (
+                    content_length.isdigit()
+                    and "Content-Encoding" not in response.headers
+                    and int(content_length) > MAX_PDF_BYTES
+                ):
+                    raise too_large
+                if content_length.isdigit() and "Content-Encoding" not in response.headers:
+                    _preallocate(f, int(content_length))
+                
+                # Sinon, interrompre dès que la limite est franchie ; la taille
+                # comptée est celle décompressée, le plafond tient donc aussi
+                # pour les réponses gzip
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    received += len(chunk)
+                    if received > MAX_PDF_BYTES:
+                        raise too_large
+                    f.write(chunk)
+                    hasher.update(chunk)
+                f.truncate()
+        except (httpx.HTTPError, httpx.InvalidURL) as e:
+            raise HTTPException(status_code=400, detail=f"Failed to download PDF: {e}")
+        
+        # Vérifier que c'est bien un PDF
+        f.seek(0)
+        if f.read(4) != b"%PDF":
+            raise HTTPException(status_code=400, detail="Downloaded file is not a valid PDF")
+    
+    return hasher.hexdigest()
 
 # ==================== ENDPOINT RACINE ====================
 
@@ -55,14 +597,18 @@ async def root():
         "endpoints": {
             "/": "Status check",
             "/health": "Health check",
-            "/convert": "Convert PDF to HTML (POST)"
+            "/convert": "Convert PDF to HTML (POST)",
+            "/download/{job_id}": "Download a converted HTML file"
         }
     }
 
+# Réponse pré-sérialisée : le healthcheck est appelé en boucle par l'orchestrateur
+_HEALTH_RESPONSE = Response(content=b'{"status":"healthy"}', media_type="application/json")
+
 @app.get("/health")
 async def health():
     """Health check endpoint"""
-    return {"status": "healthy"}
+    return _HEALTH_RESPONSE
 
 # ==================== ENDPOINT /convert POUR N8N ====================
 
@@ -76,7 +622,9 @@ async def convert_pdf_to_html_n8n(request: Request):
     {
         "pdf_b64": "...",  // optionnel - PDF encodé en base64
         "pdf_url": "...",  // optionnel - URL du PDF
-        "file_name": "..." // optionnel - nom du fichier
+        "file_name": "...", // optionnel - nom du fichier
+        "return_url": false, // optionnel - renvoyer un lien au lieu du HTML
+        "return_html": false // optionnel - renvoyer le HTML brut (text/html)
     }
     
     Réponse:
@@ -86,103 +634,114 @@ async def convert_pdf_to_html_n8n(request: Request):
         "file_name": "...",
         "size": 12345
     }
+    
+    Avec "return_url": true, "html_content" est remplacé par
+    "url": "/download/<job_id>" et "size" est la taille du fichier en octets
+    
+    Avec "return_html": true, la réponse est directement le document HTML
+    (text/html, nom du fichier dans Content-Disposition), sans JSON ni copie
+    en mémoire
     """
     try:
-        data = await request.json()
-        
-        # Récupérer le PDF
-        pdf_content = None
-        file_name = data.get('file_name', 'input.pdf')
+        # Analyser et valider le JSON en une passe (parseur Rust de pydantic-core)
+        try:
+            payload = ConvertRequest.model_validate_json(await request.body())
+        except ValidationError as e:
+            raise HTTPException(status_code=400, detail=_validation_detail(e))
         
-        if data.get('pdf_b64'):
-            # Valider et décoder le base64
-            pdf_content = b64_to_pdf_bytes(data['pdf_b64'])
+        file_name = payload.file_name if payload.file_name is not None else 'input.pdf'
         
-        elif data.get('pdf_url'):
-            # Télécharger depuis l'URL
-            try:
-                response = requests.get(data['pdf_url'], timeout=60)
-                response.raise_for_status()
-                pdf_content = response.content
-                
-                # Vérifier que c'est bien un PDF
-                if not pdf_content.startswith(b"%PDF"):
-                    raise HTTPException(status_code=400, detail="Downloaded file is not a valid PDF")
+        # Répertoire de travail (PDF d'entrée et sortie), supprimé à la sortie
+        # du bloc même en cas d'erreur
+        with tempfile.TemporaryDirectory(prefix="job-", dir=SCRATCH_DIR) as work_dir:
+            pdf_path = os.path.join(work_dir, 'input.pdf')
+            output_html = os.path.join(work_dir, 'output.html')
+            
+            if payload.pdf_b64:
+                # Valider et décoder le base64 (hors boucle pour les gros payloads)
+                if len(payload.pdf_b64) > B64_THREADPOOL_THRESHOLD:
+                    pdf_digest = await run_in_threadpool(_write_pdf_b64, payload.pdf_b64, pdf_path)
+                else:
+                    pdf_digest = _write_pdf_b64(payload.pdf_b64, pdf_path)
+            
+            else:
+                # Télécharger depuis l'URL directement sur le disque
+                pdf_digest = await _download_pdf(payload.pdf_url, pdf_path)
                 
                 # Extraire le nom du fichier de l'URL
                 if not file_name or file_name == "input.pdf":
-                    file_name = data['pdf_url'].split('/')[-1]
+                    file_name = payload.pdf_url.split('/')[-1]
                     if not file_name.endswith('.pdf'):
                         file_name = 'input.pdf'
-            except requests.RequestException as e:
-                raise HTTPException(status_code=400, detail=f"Failed to download PDF: {e}")
-        
-        else:
-            raise HTTPException(status_code=400, detail="Either pdf_b64 or pdf_url must be provided")
-        
-        # Créer un fichier temporaire pour le PDF
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_pdf:
-            tmp_pdf.write(pdf_content)
-            pdf_path = tmp_pdf.name
-        
-        # Créer un répertoire temporaire pour la sortie
-        output_dir = tempfile.mkdtemp()
-        output_html = os.path.join(output_dir, 'output.html')
-        
-        try:
-            # Exécuter pdf2htmlEX
-            subprocess.run([
-                'pdf2htmlEX',
-                '--zoom', '1.3',
-                '--process-outline', '0',
-                '--embed-css', '1',
-                '--embed-javascript', '1',
-                '--embed-image', '1',
-                '--embed-font', '1',
-                pdf_path,
-                'output.html'
-            ], cwd=output_dir, check=True, capture_output=True, timeout=300)
-            
-            # Lire le HTML généré
-            if not os.path.exists(output_html):
-                raise HTTPException(status_code=500, detail="HTML output file not created")
             
-            with open(output_html, 'r', encoding='utf-8') as f:
-                html_content = f.read()
+            # Servir depuis le cache si ce PDF a déjà été converti
+            cached_html = _cache_get(pdf_digest)
             
+            if cached_html is None:
+                async with _get_convert_sem():
+                    # Une requête identique a pu terminer pendant l'attente
+                    cached_html = _cache_get(pdf_digest)
+                    if cached_html is None:
+                        # Exécuter pdf2htmlEX
+                        await _run_pdf2htmlex(pdf_path, work_dir)
+                        
+                        if not os.path.exists(output_html):
+                            raise HTTPException(status_code=500, detail="HTML output file not created")
+                        
+                        cached_html = await _cache_put(pdf_digest, output_html)
+        
+        # Aucune suspension depuis _cache_get/_cache_put : l'entrée est encore
+        # là, l'épingler pour qu'une autre requête ne l'évince pas avant lecture
+        _cache_pin(pdf_digest)
+        try:
             # Préparer le nom du fichier de sortie
             output_filename = file_name.replace('.pdf', '.html')
             
-            return {
-                "success": True,
-                "html_content": html_content,
-                "file_name": output_filename,
-                "size": len(html_content)
-            }
-        
-        except subprocess.CalledProcessError as e:
-            error_msg = e.stderr.decode('utf-8') if e.stderr else str(e)
-            raise HTTPException(status_code=500, detail=f"pdf2htmlEX failed: {error_msg}")
-        
-        except subprocess.TimeoutExpired:
-            raise HTTPException(status_code=504, detail="Conversion timeout (>5 minutes)")
-        
+            # Renvoyer le document lui-même, sans passer par le JSON
+            if payload.return_html:
+                return await _html_file_response(pdf_digest, cached_html, request, filename=output_filename)
+            
+            # Renvoyer un lien plutôt que le contenu (gros documents)
+            if payload.return_url:
+                return {
+                    "success": True,
+                    "file_name": output_filename,
+                    "url": f"/download/{pdf_digest}",
+                    "size": os.path.getsize(cached_html)
+                }
+            
+            # Lire le HTML généré (hors boucle, il peut peser plusieurs Mo)
+            html_content = await run_in_threadpool(_read_text, cached_html)
         finally:
-            # Nettoyer les fichiers temporaires
-            try:
-                os.unlink(pdf_path)
-            except:
-                pass
-            try:
-                shutil.rmtree(output_dir)
-            except:
-                pass
+            _cache_unpin(pdf_digest)
+        
+        return {
+            "success": True,
+            "html_content": html_content,
+            "file_name": output_filename,
+            "size": len(html_content)
+        }
     
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
+# ==================== ENDPOINT /download ====================
+
+@app.get("/download/{job_id}")
+async def download_html(job_id: str, request: Request):
+    """
+    Renvoie le HTML d'une conversion précédente (voir "return_url" de /convert)
+    Le fichier est servi tel quel depuis le disque, déjà compressé en gzip
+    si le client l'accepte
+    """
+    html_path = _cache_get(job_id) if _DIGEST_RE.fullmatch(job_id) else None
+    if html_path is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job_id")
+    
+    return await _html_file_response(job_id, html_path, request)
+
 # ==================== DÉMARRAGE ====================
 
 if __name__ == "__main__":
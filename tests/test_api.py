@@ -1,15 +1,33 @@
+import asyncio
+import gzip
+import os
 import shutil
+import threading
+from collections import OrderedDict
 
 import pytest
 
-pytest.importorskip("httpx")
+httpx = pytest.importorskip("httpx")
 
 from fastapi.testclient import TestClient
 
+import app as app_module
 from app import app
 
 client = TestClient(app)
 
+
+@pytest.fixture
+def isolated_cache(tmp_path, monkeypatch):
+    """Point the conversion cache at an empty directory with fresh state."""
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setattr(app_module, "CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(app_module, "_cache_index", OrderedDict())
+    monkeypatch.setattr(app_module, "_cache_size", 0)
+    monkeypatch.setattr(app_module, "_cache_pins", {})
+    monkeypatch.setattr(app_module, "_gzip_tasks", {})
+    return cache_dir
+
 SAMPLE_PDF_B64 = (
     "JVBERi0xLjQKJeLjz9MKMSAwIG9iago8PAovVHlwZSAvQ2F0YWxvZwovUGFnZXMgMiAwIFIKPj4K"
     "ZW5kb2JqCjIgMCBvYmoKPDwKL1R5cGUgL1BhZ2VzCi9LaWRzIFszIDAgUl0KL0NvdW50IDEKPj4K"
@@ -58,3 +76,212 @@ def test_validation_error_when_missing_sources():
 def test_alias_endpoint_uses_same_handler():
     response = client.post("/pdf2htmlex", json={})
     assert response.status_code == 422
+
+
+def test_conversion_cache_evicts_least_recently_used(isolated_cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "CACHE_MAX_BYTES", 10)
+
+    for digest in ("a", "b"):
+        html_path = tmp_path / f"{digest}.html"
+        html_path.write_text("12345")
+        asyncio.run(app_module._cache_put(digest, str(html_path)))
+
+    # Touch "a" so that "b" becomes the least recently used entry
+    assert app_module._cache_get("a") is not None
+    html_path = tmp_path / "c.html"
+    html_path.write_text("12345")
+    asyncio.run(app_module._cache_put("c", str(html_path)))
+
+    assert app_module._cache_get("b") is None
+    assert app_module._cache_get("a") is not None
+    assert app_module._cache_get("c") is not None
+
+
+def test_pinned_cache_entry_is_not_evicted(isolated_cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "CACHE_MAX_BYTES", 5)
+
+    html_path = tmp_path / "a.html"
+    html_path.write_text("12345")
+    cached = asyncio.run(app_module._cache_put("a", str(html_path)))
+
+    # "a" is in use by a request while "b" pushes the cache over its limit
+    app_module._cache_pin("a")
+    html_path = tmp_path / "b.html"
+    html_path.write_text("12345")
+    asyncio.run(app_module._cache_put("b", str(html_path)))
+    assert os.path.exists(cached)
+
+    # Releasing the entry applies the deferred eviction
+    app_module._cache_unpin("a")
+    assert not os.path.exists(cached)
+    assert app_module._cache_get("b") is not None
+
+
+def test_concurrent_gzip_requests_compress_once(isolated_cache, tmp_path):
+    html_path = tmp_path / "a.html"
+    html_path.write_text("<html>" + "x" * 10000 + "</html>")
+
+    async def scenario():
+        await app_module._cache_put("a", str(html_path))
+        return await asyncio.gather(*(app_module._cache_gzip("a") for _ in range(5)))
+
+    gz_paths = asyncio.run(scenario())
+
+    assert len(set(gz_paths)) == 1
+    html_size = os.path.getsize(app_module._cache_path("a"))
+    gz_size = os.path.getsize(gz_paths[0])
+    assert app_module._cache_index["a"] == html_size + gz_size
+    assert app_module._cache_size == html_size + gz_size
+    assert sorted(os.listdir(isolated_cache)) == ["a.html", "a.html.gz"]
+
+
+def test_gzip_outliving_its_client_keeps_the_entry_until_done(isolated_cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "CACHE_MAX_BYTES", 5)
+    started, release = threading.Event(), threading.Event()
+    gzip_file = app_module._gzip_file
+
+    def slow_gzip_file(src, dst):
+        started.set()
+        release.wait(5)
+        return gzip_file(src, dst)
+
+    monkeypatch.setattr(app_module, "_gzip_file", slow_gzip_file)
+
+    async def scenario():
+        html_path = tmp_path / "a.html"
+        html_path.write_text("12345")
+        await app_module._cache_put("a", str(html_path))
+
+        # The client disconnects while "a" is being compressed
+        request = asyncio.ensure_future(app_module._cache_gzip("a"))
+        await asyncio.get_event_loop().run_in_executor(None, started.wait, 5)
+        request.cancel()
+
+        # "b" pushes the cache over its limit: "a" is still held by the gzip task
+        html_path = tmp_path / "b.html"
+        html_path.write_text("12345")
+        await app_module._cache_put("b", str(html_path))
+        assert os.path.exists(app_module._cache_path("a"))
+
+        release.set()
+        while app_module._gzip_tasks:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+
+    # The deferred eviction removed "a" together with its fresh .gz
+    assert sorted(os.listdir(isolated_cache)) == ["b.html"]
+    assert list(app_module._cache_index) == ["b"]
+    assert app_module._cache_size == 5
+    assert app_module._cache_pins == {}
+
+
+def test_cache_load_removes_orphan_gzip_files(isolated_cache):
+    isolated_cache.mkdir()
+    (isolated_cache / "a.html").write_text("12345")
+    (isolated_cache / "a.html.gz").write_bytes(b"gz")
+    (isolated_cache / "b.html.gz").write_bytes(b"gz")
+
+    app_module._cache_load()
+
+    assert sorted(os.listdir(isolated_cache)) == ["a.html", "a.html.gz"]
+    assert app_module._cache_size == 7
+
+
+def test_download_unknown_job_returns_404():
+    response = client.get("/download/" + "0" * 64)
+    assert response.status_code == 404
+
+    response = client.get("/download/not-a-digest")
+    assert response.status_code == 404
+
+
+def test_write_pdf_b64_decodes_in_chunks(tmp_path, monkeypatch):
+    import base64
+    import hashlib
+
+    monkeypatch.setattr(app_module, "B64_DECODE_CHUNK", 8)
+    pdf_bytes = base64.b64decode(SAMPLE_PDF_B64)
+    pdf_path = tmp_path / "input.pdf"
+
+    digest = app_module._write_pdf_b64("data:application/pdf;base64," + SAMPLE_PDF_B64, str(pdf_path))
+
+    assert pdf_path.read_bytes() == pdf_bytes
+    assert digest == hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def test_pdf_b64_over_size_limit_is_rejected(monkeypatch):
+    monkeypatch.setattr(app_module, "MAX_PDF_BYTES", 16)
+    response = client.post("/convert", json={"pdf_b64": SAMPLE_PDF_B64})
+    assert response.status_code == 413
+
+
+async def _chunked_pdf_body():
+    yield b"%PDF-1.4\n"
+    for _ in range(4):
+        yield b"x" * 512
+
+
+@pytest.mark.parametrize(
+    "make_response",
+    [
+        # Announced size over the limit
+        lambda: httpx.Response(200, content=b"%PDF-1.4\n" + b"x" * 2048),
+        # No Content-Length, the streamed body crosses the limit
+        lambda: httpx.Response(200, content=_chunked_pdf_body()),
+        # Small compressed body that inflates past the limit
+        lambda: httpx.Response(
+            200,
+            content=gzip.compress(b"%PDF-1.4\n" + b"\0" * 100000),
+            headers={"Content-Encoding": "gzip"},
+        ),
+    ],
+    ids=["content-length", "chunked", "gzip"],
+)
+def test_pdf_url_over_size_limit_is_rejected(monkeypatch, make_response):
+    monkeypatch.setattr(app_module, "MAX_PDF_BYTES", 1024)
+    monkeypatch.setattr(
+        app_module,
+        "_http_client",
+        httpx.AsyncClient(transport=httpx.MockTransport(lambda request: make_response())),
+    )
+    response = client.post("/convert", json={"pdf_url": "http://pdfs.test/big.pdf"})
+    assert response.status_code == 413
+
+
+def test_convert_requires_a_source():
+    response = client.post("/convert", json={"file_name": "x.pdf"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Either pdf_b64 or pdf_url must be provided"
+
+
+def test_invalid_field_is_named_in_the_error():
+    response = client.post("/convert", json={"pdf_b64": 123})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "pdf_b64: Input should be a valid string"
+
+
+@pytest.mark.parametrize("pdf_b64", ["JVBERi0", "JVBE!!==", "JVBERi0x===="])
+def test_malformed_base64_is_rejected_before_decoding(pdf_b64):
+    response = client.post("/convert", json={"pdf_b64": pdf_b64})
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("Invalid base64")
+
+
+def test_invalid_pdf_url_is_a_client_error():
+    with TestClient(app) as lifespan_client:
+        response = lifespan_client.post("/convert", json={"pdf_url": "http://[::1"})
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("Failed to download PDF")
+
+
+@pytest.mark.parametrize("pdf_b64", ["JVBERi0xLjQK!!!!QUFB", "JVBERi0xLjQKQQ==QUFB"])
+def test_non_alphabet_base64_is_rejected_whatever_the_size(tmp_path, monkeypatch, pdf_b64):
+    # Small slices put "QQ==" exactly at the end of a non-final slice
+    monkeypatch.setattr(app_module, "B64_DECODE_CHUNK", 16)
+    pdf_path = str(tmp_path / "input.pdf")
+    for payload in (pdf_b64, "JVBERi0xLjQK" * 100 + pdf_b64):
+        with pytest.raises(app_module.HTTPException) as exc_info:
+            app_module._write_pdf_b64(payload, pdf_path)
+        assert exc_info.value.status_code == 400
+